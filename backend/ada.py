@@ -295,6 +295,7 @@ class AudioLoop:
 
     def stop(self):
         self.stop_event.set()
+        self.cad_agent.close()
         
     def resolve_tool_confirmation(self, request_id, confirmed):
         print(f"[ADA DEBUG] [RESOLVE] resolve_tool_confirmation called. ID: {request_id}, Confirmed: {confirmed}")
@@ -1,68 +1,923 @@
 import os
+import re
+import ast
+import sys
 import json
+import shutil
+import hashlib
+import tempfile
+import time
 import asyncio
+import threading
+import subprocess
+import aiofiles
 from datetime import datetime
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
 
 load_dotenv()
 
+# Opening code fence: any run of 3+ backticks or tildes, optionally followed by a language tag
+_FENCE_OPEN_RE = re.compile(r'^\s*(`{3,}|~{3,})\s*(\w[\w-]*)?')
+# Opener at the end of a line of prose ("Here you go: ```python"); only python tags count, since
+# "Use ```python x``` here" would otherwise open a block tagged "here"
+_INLINE_FENCE_OPEN_RE = re.compile(r'(?i)(`{3,}|~{3,})[ \t]*(python-3|python3|python|py)\s*$')
+_PYTHON_FENCE_LANGS = {"python", "py", "python3", "python-3"}
+
+
+def _extract_code(raw: str, allow_unlabeled: bool = True) -> Optional[str]:
+    """
+    Returns the body of the first python-tagged fenced code block in `raw`, or, if there is none and
+    `allow_unlabeled` is set, of the first unlabeled block (plans or sample output often come first).
+    A fence only closes on a run of the same character at least as long as the opener,
+    so 4-backtick / ~~~ fences and fences nested inside docstrings are handled.
+    Returns None if no complete block is found.
+    """
+    fence = None
+    lang = ""
+    body = []
+    unlabeled = None
+    for line in raw.split("\n"):
+        if fence is None:
+            m = _FENCE_OPEN_RE.match(line) or _INLINE_FENCE_OPEN_RE.search(line)
+            if m:
+                fence = m.group(1)
+                lang = (m.group(2) or "").lower()
+                body = []
+            continue
+
+        run = line.strip()
+        if len(run) >= len(fence) and run == fence[0] * len(run):
+            if lang in _PYTHON_FENCE_LANGS:
+                return "\n".join(body).strip()
+            if not lang and unlabeled is None:
+                unlabeled = "\n".join(body).strip()
+            # Closed a non-python block, keep looking
+            fence = None
+            continue
+        body.append(line)
+    return unlabeled if allow_unlabeled else None
+
+
+# Lifetime of the Gemini context cache holding the system instruction; it is extended once
+# less than _CONTEXT_CACHE_RENEW_S remains
+_CONTEXT_CACHE_TTL_S = 3600
+_CONTEXT_CACHE_RENEW_S = 600
+# Gemini refuses to cache fewer tokens than this (Pro models), so smaller instructions go inline
+_CONTEXT_CACHE_MIN_TOKENS = 4096
+# Wait before trying again after a failed create/renew call
+_CONTEXT_CACHE_RETRY_S = 300
+
+# Disk cache of successful generations, keyed by system instruction + prompt
+_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ada_cad_cache")
+_CACHE_MAX_ENTRIES = 64
+
+
+# Responses that held no usable script, then common build123d / OpenCascade failures, checked in
+# order. The tag is fed back to the model instead of the full stderr so retries get a short, targeted prompt.
+# A tuple of patterns matches only if each one does; separate searches stay linear on 16 KB of stderr.
+_ERROR_CATEGORIES = [
+    ("EMPTY_RESPONSE", re.compile(r"^The model returned an empty response")),
+    ("NO_CODE_BLOCK", re.compile(r"^No ```python code block was found")),
+    ("PREFLIGHT_FAILED", re.compile(r"^Preflight check failed")),
+    ("OLD_PASCALCASE_API", re.compile(r"NameError: name '(MakeFace|Extrude|Fillet|Chamfer|Revolve|Loft|Sweep|Offset)' is not defined")),
+    ("FILLET_RADIUS_TOO_LARGE", (
+        re.compile(r"(?i)fillet|chamfer"),
+        re.compile(r"BRep_API: command not done|StdFail_NotDone|Standard_Failure|Standard_ConstructionError")
+    )),
+    ("GEOMETRY_OPERATION_FAILED", re.compile(r"BRep_API: command not done|StdFail_NotDone")),
+    ("INVALID_CONSTRUCTION", re.compile(r"Standard_ConstructionError|Standard_DomainError")),
+    ("VECTOR_TYPE_ERROR", re.compile(r"TypeError:.*(Vector|Vertex|Location)")),
+    ("SYNTAX_ERROR", re.compile(r"SyntaxError|IndentationError")),
+    ("IMPORT_ERROR", re.compile(r"ImportError|ModuleNotFoundError")),
+    ("UNDEFINED_NAME", re.compile(r"NameError")),
+    ("ATTRIBUTE_ERROR", re.compile(r"AttributeError")),
+    ("TYPE_ERROR", re.compile(r"TypeError")),
+    ("VALUE_ERROR", re.compile(r"ValueError")),
+    ("MISSING_EXPORT", re.compile(r"no STL was written to OUTPUT_STL")),
+    ("WORKER_CRASH", re.compile(r"CAD worker crashed")),
+    ("TIMEOUT", re.compile(r"^Script timed out")),
+]
+
+
+def _classify_error(stderr: str):
+    """
+    Returns (category, summary) for a failed attempt: a short tag for the kind of failure
+    and the last two non-empty lines of stderr (usually the failing line and the exception).
+    """
+    category = "RUNTIME_ERROR"
+    for tag, patterns in _ERROR_CATEGORIES:
+        if not isinstance(patterns, tuple):
+            patterns = (patterns,)
+        if all(pattern.search(stderr) for pattern in patterns):
+            category = tag
+            break
+    lines = [line for line in stderr.strip().split("\n") if line.strip()]
+    summary = "\n".join(lines[-2:]) if lines else "Unknown error"
+    return category, summary
+
+
+# Old PascalCase operations the model still reaches for; build123d uses lowercase builders
+_FORBIDDEN_CALLS = {"MakeFace", "Extrude", "Fillet", "Chamfer", "Revolve", "Loft", "Sweep", "Offset"}
+
+
+def _preflight(code: str) -> List[str]:
+    """
+    Statically checks a generated script so obviously broken ones are rejected without
+    starting an execution. Returns a list of problems (empty if the script looks runnable).
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return [f"SyntaxError: {e.msg} (line {e.lineno})"]
+
+    problems = []
+    calls = set()
+    assigns_result = False
+    exports_to_output = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            func = node.func
+            name = func.id if isinstance(func, ast.Name) else getattr(func, "attr", None)
+            calls.add(name)
+            if name == "export_stl" and any(
+                isinstance(arg, ast.Name) and arg.id == "OUTPUT_STL"
+                for arg in node.args + [kw.value for kw in node.keywords]
+            ):
+                exports_to_output = True
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                for name in ast.walk(target):
+                    if isinstance(name, ast.Name) and name.id == "result_part":
+                        assigns_result = True
+
+    for name in sorted(calls & _FORBIDDEN_CALLS):
+        problems.append(f"`{name}()` is an old PascalCase name, use `{name.lower()}()`")
+    if not assigns_result:
+        problems.append("the final object is never assigned to `result_part`")
+    if not exports_to_output:
+        problems.append("`export_stl(result_part, OUTPUT_STL)` is never called")
+    return problems
+
+
+# Header that defines OUTPUT_STL in saved scripts so they run standalone. During execution the worker
+# predefines OUTPUT_STL instead, so traceback line numbers match the code the model wrote.
+_OUTPUT_HEADER = "OUTPUT_STL = "
+
+
+def _inject_output_path(code: str, output_stl: str) -> str:
+    """
+    Points the script's export at `output_stl` by defining OUTPUT_STL at the top, after the
+    module docstring and any `from __future__` imports (which must come first).
+    """
+    at = 0
+    try:
+        body = ast.parse(code).body
+    except SyntaxError:
+        body = []
+    for i, node in enumerate(body):
+        is_docstring = (
+            i == 0 and isinstance(node, ast.Expr)
+            and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+        )
+        if not (is_docstring or (isinstance(node, ast.ImportFrom) and node.module == "__future__")):
+            break
+        at = node.end_lineno
+    lines = code.split("\n")
+    # repr() escapes backslashes, so Windows paths are safe inside the string literal
+    lines.insert(at, f"{_OUTPUT_HEADER}{output_stl!r}")
+    return "\n".join(lines)
+
+
+def _strip_output_path(code: str) -> str:
+    """Removes the header added by `_inject_output_path`."""
+    lines = code.split("\n")
+    for i, line in enumerate(lines):
+        if line.startswith(_OUTPUT_HEADER):
+            del lines[i]
+            return "\n".join(lines)
+    return code
+
+
+def _unique_output_path(work_dir: str) -> str:
+    """Claims a timestamped STL path in `work_dir` that no other generation is using."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    path = os.path.join(work_dir, f"output_{timestamp}.stl")
+    suffix = 1
+    while True:
+        try:
+            # O_EXCL makes the claim atomic when two generations finish in the same second
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return path
+        except FileExistsError:
+            path = os.path.join(work_dir, f"output_{timestamp}_{suffix}.stl")
+            suffix += 1
+
+
+def _remove_quietly(path: str):
+    """Deletes a file, ignoring errors if it is already gone."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# Only the tail of a failed script's stderr is kept; that's where the traceback is,
+# and multi-MB OpenCascade logs would otherwise be pasted into the next prompt
+_STDERR_TAIL_CHARS = 16384
+
+# Scripts running longer than this are killed along with their worker
+_SCRIPT_TIMEOUT_S = 120
+# Workers are replaced after this many scripts, so state a script leaves behind that the
+# worker can't reset (e.g. monkeypatched build123d) doesn't live forever
+_WORKER_MAX_SCRIPTS = 50
+# Idle workers kept per agent (enough for the speculative first round); extras are stopped
+_MAX_IDLE_WORKERS = 2
+
+# Persistent CAD worker: imports build123d once, then runs one script per JSON line on stdin
+# and answers with one JSON line. The protocol uses private copies of stdin/stdout; scripts see
+# devnull on fd 0 and stderr (discarded) on fd 1, so they can neither read the requests nor
+# corrupt the replies. The cwd, sys.path and hand-made sys.modules entries are reset after each script.
+_WORKER_SRC = r"""
+import io, os, sys, json, traceback
+
+class Tail(io.TextIOBase):
+    def __init__(self, limit):
+        self.limit = limit
+        self.buf = ""
+    def writable(self):
+        return True
+    def write(self, s):
+        self.buf = (self.buf + s)[-self.limit:]
+        return len(s)
+
+limit = int(sys.argv[1])
+requests = os.fdopen(os.dup(0), "r", encoding="utf-8")
+proto = os.fdopen(os.dup(1), "w", encoding="utf-8")
+null_fd = os.open(os.devnull, os.O_RDONLY)
+os.dup2(null_fd, 0)
+os.close(null_fd)
+null_in = open(os.devnull, encoding="utf-8")
+os.dup2(2, 1)
+try:
+    import build123d
+except Exception:
+    pass
+home = os.getcwd()
+for line in requests:
+    request = json.loads(line)
+    path = request["path"]
+    namespace = {"__name__": "__main__", "__file__": path}
+    if request.get("output_stl"):
+        namespace["OUTPUT_STL"] = request["output_stl"]
+    err = Tail(limit)
+    sys.stdin, sys.stdout, sys.stderr = null_in, sys.__stderr__, err
+    modules = dict(sys.modules)
+    sys_path = list(sys.path)
+    ok = True
+    try:
+        with open(path, encoding="utf-8") as f:
+            source = f.read()
+        exec(compile(source, path, "exec"), namespace)
+    except SystemExit as e:
+        ok = e.code in (None, 0)
+        if not ok:
+            err.write(f"SystemExit: the script exited with code {e.code!r}\n")
+    except BaseException:
+        ok = False
+        traceback.print_exc(file=err)
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = null_in, sys.__stderr__, sys.__stderr__
+    # Modules imported from disk are the same for every script and stay cached; entries a
+    # script planted or replaced by hand (no import spec) are undone
+    planted = [name for name in sys.modules.keys() - modules.keys()
+               if getattr(sys.modules[name], "__spec__", None) is None]
+    for name in planted:
+        del sys.modules[name]
+    sys.modules.update(modules)
+    sys.path[:] = sys_path
+    os.chdir(home)
+    proto.write(json.dumps({"ok": ok, "stderr": err.buf}) + "\n")
+    proto.flush()
+"""
+
+
+class _CadWorker:
+    """A long-lived interpreter that runs generated CAD scripts without paying startup + import each time."""
+
+    def __init__(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, "-u", "-c", _WORKER_SRC, str(_STDERR_TAIL_CHARS)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding="utf-8"
+        )
+        self.runs = 0  # Scripts sent to this worker
+        self._timed_out = False
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def _kill_on_timeout(self):
+        self._timed_out = True
+        self.close()
+
+    def run(self, script_path: str, output_stl: Optional[str] = None, timeout: float = _SCRIPT_TIMEOUT_S):
+        """
+        Blocking. Runs one script, with OUTPUT_STL predefined as `output_stl` if given, and returns
+        (returncode, stderr). Raises TimeoutError (after killing the worker) if the script runs longer
+        than `timeout` seconds, RuntimeError if the worker died.
+        """
+        self.runs += 1
+        self.proc.stdin.write(json.dumps({"path": script_path, "output_stl": output_stl}) + "\n")
+        self.proc.stdin.flush()
+        timer = threading.Timer(timeout, self._kill_on_timeout)
+        timer.daemon = True
+        timer.start()
+        try:
+            line = self.proc.stdout.readline()
+        finally:
+            timer.cancel()
+        if not line:
+            if self._timed_out:
+                raise TimeoutError(f"Script timed out after {timeout}s and was stopped.")
+            try:
+                code = self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                code = None
+            raise RuntimeError(f"CAD worker exited unexpectedly (code {code})")
+        reply = json.loads(line)
+        return (0 if reply["ok"] else 1), reply["stderr"]
+
+    def close(self):
+        try:
+            self.proc.kill()
+            # Reap it so repeated restarts don't pile up zombie interpreters
+            self.proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+
+
 class CadAgent:
+    # One Gemini client (and its HTTP connection pool) shared by every CadAgent
+    _client = None
+    _client_lock = threading.Lock()
+
+    @classmethod
+    def _get_client(cls):
+        """Returns the shared Gemini client, creating it on first use."""
+        with cls._client_lock:
+            if cls._client is None:
+                cls._client = genai.Client(http_options={"api_version": "v1beta"}, api_key=os.getenv("GEMINI_API_KEY"))
+            return cls._client
+
     def __init__(self, on_thought=None, on_status=None):
-        self.client = genai.Client(http_options={"api_version": "v1beta"}, api_key=os.getenv("GEMINI_API_KEY"))
+        self.client = self._get_client()
         # Using Gemini 2.5 Pro for thinking/streaming support
         self.model = "gemini-3-pro-preview"
-        self.on_thought = on_thought  # Callback for streaming thoughts 
+        self.on_thought = on_thought  # Callback for streaming thoughts, fed by _pump_thoughts
         self.on_status = on_status  # Callback for retry status info
+        self.speculative_attempts = 2  # Concurrent samples on the first generation round
+        # One bounded queue per thought consumer (the on_thought pump and each thoughts() iterator);
+        # every consumer gets every thought, and nothing is queued while there are none
+        self._thought_queues = []
+        self._thought_pump = None
+        self._pump_queue = None
+        self._idle_workers = []  # Persistent _CadWorker processes, started on first use
+        self._busy_workers = set()  # Workers running a script right now
+        self._workers_lock = threading.Lock()  # _run_script runs in several threads at once
+        self._closed = False  # After close(), workers are stopped instead of kept
+        self.cache_dir = _CACHE_DIR
+        self._last_script_path = None  # Script of the last successful generation/iteration
+        self._last_code = None  # ...and its code, so chained iterations skip the disk read
         
         self.system_instruction = """
-You are a Python-based 3D CAD Engineer using the `build123d` library.
-Your goal is to write a Python script that generates a 3D model based on the user's request.
+You are a 3D CAD engineer writing Python scripts with the `build123d` library.
 
 Requirements:
-1. Start with `from build123d import *`.
-2. Include `import numpy as np` if you use any numpy functions (like `np.sign`, `np.pi`).
-3. You MUST assign the final object to a variable named `result_part`.
-4. If you create a sketch or line, extrude it to make it a solid `Part`.
-5. The model should be centered at (0,0,0) and have reasonable dimensions (mm).
-6. **IMPORTANT**: Do NOT use old or PascalCase function names for core operations.
-   - Use `make_face()` instead of `MakeFace()`.
-   - Use `extrude()` instead of `Extrude()`.
-   - Use `fillet()` instead of `Fillet()`.
-   - Use `chamfer()` instead of `Chamfer()`.
-   - Use `revolve()` instead of `Revolve()`.
-   - Use `loft()` instead of `Loft()`.
-   - Use `sweep()` instead of `Sweep()`.
-   - Use `offset()` instead of `Offset()`.
-   - generally prefer lowercase builder methods inside contexts.
-
-7. **Vector Access**: Do NOT access vector components like `v.X`, `v.Y`, `v.Z` unless you are sure they exist (use `v.X` etc on Vector objects, but ensure they are Vectors).
-8. **Final Output**: The script MUST end by exporting the final part to an STL file named 'output.stl'.
-   - `export_stl(result_part, 'output.stl')`
-
-9. **Robustness**: Operations like `fillet()` and `chamfer()` will crash if the radius is too large for the geometry.
-   - Use conservative values (e.g., 0.5mm to 2mm) unless you are certain of the dimensions.
-   - If a fillet is purely aesthetic, keep it small to ensure success.
-
-Example Script:
-```python
-from build123d import *
+1. Start with `from build123d import *`; add `import numpy as np` if you use numpy.
+2. Assign the final solid `Part` to `result_part` (extrude sketches/lines into solids).
+3. Center the model at (0,0,0) with reasonable dimensions in mm.
+4. Use lowercase builders: make_face, extrude, fillet, chamfer, revolve, loft, sweep, offset (NOT their PascalCase equivalents).
+5. Only access `.X`/`.Y`/`.Z` on actual `Vector` objects.
+6. End with `export_stl(result_part, OUTPUT_STL)`. `OUTPUT_STL` is predefined; don't define it or hardcode a file name.
+7. Keep fillet/chamfer radii conservative (0.5-2mm) unless you are sure of the geometry; oversized radii crash.
+"""
 
-with BuildPart() as p:
-    Box(10, 10, 10)
-    Fillet(p.edges(), radius=1)
+        # Built once; every streamed attempt uses the same settings
+        self._gen_config = types.GenerateContentConfig(
+            system_instruction=self.system_instruction,
+            temperature=1.0,
+            thinking_config=types.ThinkingConfig(include_thoughts=True)
+        )
+        # Same settings, but referencing the system instruction from a Gemini context cache
+        self._cached_gen_config = None
+        self._context_cache_name = None
+        self._context_cache_expires = 0.0
+        self._context_cache_retry_at = 0.0
+        self._context_cache_unavailable = False  # Instruction too small to cache
+        self._context_cache_task = None  # Background create/renew/delete call
+        self._instruction_tokens = None
 
-result_part = p.part
-export_stl(result_part, 'output.stl')
-```
-"""
+    def _run_script(self, script_path: str, output_stl: Optional[str] = None):
+        """
+        Blocking and thread-safe. Runs a script on an idle persistent worker, starting a new one if
+        none is free or the previous one died. Returns (returncode, stderr).
+        """
+        worker = None
+        with self._workers_lock:
+            while self._idle_workers:
+                candidate = self._idle_workers.pop()
+                if candidate.alive():
+                    worker = candidate
+                    break
+                print("[CadAgent DEBUG] [WARN] CAD worker died, restarting.")
+        try:
+            if worker is None:
+                worker = _CadWorker()
+            with self._workers_lock:
+                self._busy_workers.add(worker)
+            result = worker.run(script_path, output_stl)
+        except TimeoutError as e:
+            result = 1, str(e)
+        except (OSError, ValueError, RuntimeError) as e:
+            # Crashed mid-script (e.g. a segfault inside OpenCascade); drop it so the next call restarts
+            result = 1, f"CAD worker crashed: {e}"
+
+        with self._workers_lock:
+            self._busy_workers.discard(worker)
+            keep = (
+                worker is not None and worker.alive() and not self._closed
+                and worker.runs < _WORKER_MAX_SCRIPTS and len(self._idle_workers) < _MAX_IDLE_WORKERS
+            )
+            if keep:
+                self._idle_workers.append(worker)
+        if worker and not keep:
+            worker.close()
+        return result
+
+    async def thoughts(self) -> AsyncIterator[str]:
+        """
+        Yields model thoughts as they stream in, for consuming them at your own pace. Each iterator
+        gets its own copy of every thought emitted while it is active (alongside `on_thought`, if set);
+        thoughts from before its first iteration are not replayed.
+        """
+        queue = asyncio.Queue(maxsize=1000)
+        self._thought_queues.append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._thought_queues.remove(queue)
+
+    async def _pump_thoughts(self, queue: asyncio.Queue):
+        """Drains the pump's thought queue into `on_thought`, off the stream-reading path."""
+        while True:
+            text = await queue.get()
+            if self.on_thought:
+                try:
+                    self.on_thought(text)
+                except Exception as e:
+                    print(f"[CadAgent DEBUG] [WARN] on_thought callback failed: {e}")
+
+    def _stop_thought_pump(self):
+        if self._thought_pump:
+            self._thought_pump.cancel()
+            self._thought_pump = None
+        if self._pump_queue in self._thought_queues:
+            self._thought_queues.remove(self._pump_queue)
+        self._pump_queue = None
+
+    def close(self):
+        """Stops all persistent CAD workers and the thought pump, and deletes the context cache."""
+        self._stop_thought_pump()
+        if self._context_cache_task:
+            self._context_cache_task.cancel()
+            self._context_cache_task = None
+        name, self._context_cache_name, self._cached_gen_config = self._context_cache_name, None, None
+        if name:
+            try:
+                self._context_cache_task = asyncio.get_running_loop().create_task(self._delete_context_cache(name))
+            except RuntimeError:
+                # No event loop running (e.g. interpreter shutdown); delete synchronously
+                try:
+                    self.client.caches.delete(name=name)
+                except Exception as e:
+                    print(f"[CadAgent DEBUG] [WARN] Could not delete context cache {name}: {e}")
+        with self._workers_lock:
+            self._closed = True
+            # Busy workers are stopped too; their scripts fail, and nothing is returned to the pool
+            workers = self._idle_workers + list(self._busy_workers)
+            self._idle_workers = []
+            self._busy_workers.clear()
+        for worker in workers:
+            worker.close()
+
+    def _cache_key(self, prompt: str) -> str:
+        return hashlib.sha256((self.system_instruction + prompt).encode("utf-8")).hexdigest()
+
+    def _cache_load(self, key: str):
+        """Blocking. Returns (code, stl_data) for a cached generation, or None on a miss."""
+        stl_path = os.path.join(self.cache_dir, f"{key}.stl")
+        try:
+            with open(os.path.join(self.cache_dir, f"{key}.py"), "r") as f:
+                code = f.read()
+            with open(stl_path, "rb") as f:
+                stl_data = f.read()
+            # Mark as recently used for LRU eviction
+            os.utime(stl_path)
+        except OSError:
+            return None
+        return code, stl_data
+
+    def _cache_store(self, key: str, code: str, stl_data: bytes):
+        """Blocking. Saves a successful generation and evicts the least recently used entries."""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(os.path.join(self.cache_dir, f"{key}.py"), "w") as f:
+                f.write(code)
+            with open(os.path.join(self.cache_dir, f"{key}.stl"), "wb") as f:
+                f.write(stl_data)
+
+            entries = [
+                os.path.join(self.cache_dir, name)
+                for name in os.listdir(self.cache_dir) if name.endswith(".stl")
+            ]
+            entries.sort(key=os.path.getmtime)
+            for stl_path in entries[:-_CACHE_MAX_ENTRIES]:
+                _remove_quietly(stl_path)
+                _remove_quietly(stl_path[:-len(".stl")] + ".py")
+        except OSError as e:
+            print(f"[CadAgent DEBUG] [WARN] Could not write CAD cache: {e}")
+
+    def _get_gen_config(self):
+        """
+        Returns the config for a streamed attempt. Once a Gemini context cache holding the system
+        instruction exists, the config references it so repeat calls skip its prefill. Creating and
+        renewing the cache happens in the background, so no request waits on it; until it is ready,
+        or if the instruction is too small to cache, the instruction is sent inline.
+        """
+        now = time.monotonic()
+        task = self._context_cache_task
+        if (
+            not self._context_cache_unavailable and not self._closed
+            and (task is None or task.done()) and now >= self._context_cache_retry_at
+        ):
+            if self._context_cache_name is None:
+                self._context_cache_task = asyncio.create_task(self._create_context_cache())
+            elif now >= self._context_cache_expires - _CONTEXT_CACHE_RENEW_S:
+                self._context_cache_task = asyncio.create_task(self._renew_context_cache())
+        if self._cached_gen_config and now < self._context_cache_expires - 60:
+            return self._cached_gen_config
+        return self._gen_config
+
+    async def _create_context_cache(self):
+        """Background. Creates the context cache, unless the instruction is below the cacheable minimum."""
+        try:
+            if self._instruction_tokens is None:
+                counted = await self.client.aio.models.count_tokens(model=self.model, contents=self.system_instruction)
+                self._instruction_tokens = counted.total_tokens or 0
+            if self._instruction_tokens < _CONTEXT_CACHE_MIN_TOKENS:
+                print(f"[CadAgent DEBUG] [CACHE] System instruction is {self._instruction_tokens} tokens, too small to cache; sending it inline.")
+                self._context_cache_unavailable = True
+                return
+            cache = await self.client.aio.caches.create(
+                model=self.model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=self.system_instruction,
+                    ttl=f"{_CONTEXT_CACHE_TTL_S}s"
+                )
+            )
+        except Exception as e:
+            print(f"[CadAgent DEBUG] [WARN] Could not create context cache, sending instruction inline for now: {e}")
+            self._context_cache_retry_at = time.monotonic() + _CONTEXT_CACHE_RETRY_S
+            return
+        print(f"[CadAgent DEBUG] [CACHE] Created context cache {cache.name}")
+        self._context_cache_name = cache.name
+        self._context_cache_expires = time.monotonic() + _CONTEXT_CACHE_TTL_S
+        self._cached_gen_config = types.GenerateContentConfig(
+            cached_content=cache.name,
+            temperature=1.0,
+            thinking_config=types.ThinkingConfig(include_thoughts=True)
+        )
+
+    async def _renew_context_cache(self):
+        """Background. Extends the context cache's TTL; if that keeps failing until it expires, a new one is created."""
+        try:
+            await self.client.aio.caches.update(
+                name=self._context_cache_name,
+                config=types.UpdateCachedContentConfig(ttl=f"{_CONTEXT_CACHE_TTL_S}s")
+            )
+        except Exception as e:
+            print(f"[CadAgent DEBUG] [WARN] Could not renew context cache: {e}")
+            if time.monotonic() >= self._context_cache_expires:
+                self._context_cache_name = None
+                self._cached_gen_config = None
+            else:
+                self._context_cache_retry_at = time.monotonic() + 60
+            return
+        self._context_cache_expires = time.monotonic() + _CONTEXT_CACHE_TTL_S
+
+    async def _delete_context_cache(self, name: str):
+        """Background. Deletes the context cache so it stops being billed before its TTL runs out."""
+        try:
+            await self.client.aio.caches.delete(name=name)
+        except Exception as e:
+            print(f"[CadAgent DEBUG] [WARN] Could not delete context cache {name}: {e}")
+
+    async def _stream_code(self, prompt: str, emit_thoughts: bool = True):
+        """
+        Streams a response from Gemini, forwarding thoughts to `on_thought` and any `thoughts()` iterators.
+        Stops reading as soon as a complete code block has arrived so the script can be
+        executed while the model is still writing its closing explanation.
+        Returns (raw_content, code); code is None if no complete block was found.
+        """
+        raw_parts = []
+        code = None
+        if self.on_thought and (self._thought_pump is None or self._thought_pump.done()):
+            # Register the pump's queue now, so thoughts streamed before the task first runs are kept
+            self._stop_thought_pump()
+            self._pump_queue = asyncio.Queue(maxsize=1000)
+            self._thought_queues.append(self._pump_queue)
+            self._thought_pump = asyncio.create_task(self._pump_thoughts(self._pump_queue))
+        stream = await self.client.aio.models.generate_content_stream(
+            model=self.model,
+            contents=prompt,
+            config=self._get_gen_config()
+        )
+        # Per-token hot path: bind lookups to locals and join the answer once at the end
+        append = raw_parts.append
+        thought_queues = self._thought_queues
+        # A fence character has arrived on the line still being written
+        fence_pending = False
+        async for chunk in stream:
+            cands = chunk.candidates
+            content = cands[0].content if cands else None
+            parts = content.parts if content else None
+            if not parts:
+                continue
+            for part in parts:
+                text = part.text
+                if not text:
+                    continue
+                if part.thought:
+                    # Queue the thought for each consumer; they send it on without stalling this read
+                    if emit_thoughts:
+                        for queue in thought_queues:
+                            if not queue.full():
+                                queue.put_nowait(text)
+                    continue
+                # Accumulate answer text
+                append(text)
+                if not fence_pending:
+                    fence_pending = "`" in text or "~" in text
+                # Only re-scan once a line that could hold a fence is complete: a trailing "```"
+                # may still grow into "```python" inside a docstring and must not close the block.
+                # Mid-stream only a python-tagged block stops the read; an unlabeled one may be a plan
+                nl = text.rfind("\n")
+                if fence_pending and nl != -1:
+                    buffered = "".join(raw_parts)
+                    code = _extract_code(buffered[:buffered.rfind("\n") + 1], allow_unlabeled=False)
+                    tail = text[nl + 1:]
+                    fence_pending = "`" in tail or "~" in tail
+            if code is not None:
+                break
+        raw_content = "".join(raw_parts)
+
+        if code is not None:
+            print("[CadAgent DEBUG] [OK] Code block complete, closing stream early.")
+            aclose = getattr(stream, "aclose", None)
+            if aclose:
+                try:
+                    await aclose()
+                except Exception:
+                    pass
+        else:
+            # The stream has ended, so an unterminated last line can close the block now,
+            # and an unlabeled block is accepted if no python one came
+            code = _extract_code(raw_content)
+        return raw_content, code
+
+    async def _execute(self, code: str):
+        """
+        Writes `code` into a fresh temp directory and executes it there, so concurrent attempts
+        and generations never share a path. Returns (attempt_dir, error); on success the directory
+        holds `gen.py` and `output.stl` and the caller must remove it, on failure it is already gone.
+        """
+        attempt_dir = tempfile.mkdtemp(prefix="ada_cad_")
+        attempt_script = os.path.join(attempt_dir, "gen.py")
+        attempt_stl = os.path.join(attempt_dir, "output.stl")
+
+        try:
+            # Written as generated; the worker defines OUTPUT_STL, so no header shifts the line numbers
+            async with aiofiles.open(attempt_script, "w") as f:
+                await f.write(code)
+
+            print(f"[CadAgent DEBUG] [EXEC] Running local script: {attempt_script}")
+
+            # Execute Locally on a persistent worker (unified environment with build123d + mediapipe)
+            # Use asyncio.to_thread for Windows compatibility (asyncio subprocess pipes
+            # throw NotImplementedError on Windows with certain event loop policies)
+            try:
+                returncode, stderr = await asyncio.to_thread(self._run_script, attempt_script, attempt_stl)
+            except Exception as e:
+                print(f"[CadAgent DEBUG] [ERR] Subprocess run failed: {e}")
+                returncode, stderr = 1, str(e)
+        except asyncio.CancelledError:
+            shutil.rmtree(attempt_dir, ignore_errors=True)
+            raise
+
+        error = None
+        if returncode != 0:
+            print(f"[CadAgent DEBUG] [ERR] Script Execution Failed:\n{stderr}")
+            error = stderr
+        elif not os.path.exists(attempt_stl):
+            print(f"[CadAgent DEBUG] [ERR] '{attempt_stl}' was not generated.")
+            error = "The script executed successfully but no STL was written to OUTPUT_STL. Ensure you call `export_stl(result_part, OUTPUT_STL)` at the end."
+        else:
+            print(f"[CadAgent DEBUG] [OK] Script executed successfully.")
+
+        if error is not None:
+            await asyncio.to_thread(shutil.rmtree, attempt_dir, True)
+            return None, error
+        return attempt_dir, None
+
+    async def _save_result(self, code: str, attempt_dir: str, work_dir: str, script_path: str):
+        """
+        Moves a successful attempt into `work_dir`: the STL gets a unique timestamped name and the
+        script is saved as `script_path` (pointing at that STL) so the next iteration builds on it.
+        Removes `attempt_dir` and returns the result dict sent to the frontend.
+        """
+        try:
+            async with aiofiles.open(os.path.join(attempt_dir, "output.stl"), "rb") as f:
+                stl_data = await f.read()
+        finally:
+            await asyncio.to_thread(shutil.rmtree, attempt_dir, True)
+
+        output_stl = _unique_output_path(work_dir)
+        async with aiofiles.open(output_stl, "wb") as f:
+            await f.write(stl_data)
+        async with aiofiles.open(script_path, "w") as f:
+            await f.write(_inject_output_path(code, output_stl))
+        self._last_script_path = script_path
+        self._last_code = code
+        print(f"[CadAgent DEBUG] [file] '{output_stl}' saved.")
+
+        # Raw bytes go out as a binary Socket.IO attachment, no base64 inflation
+        return {
+            "format": "stl",
+            "data": stl_data,
+            "file_path": output_stl
+        }
+
+    async def _one_attempt(self, prompt: str, emit_thoughts: bool = True):
+        """
+        Runs a single attempt: streams a script from Gemini, checks it and executes it.
+        Returns (code, attempt_dir, error). error is None when the script ran and produced an STL.
+        """
+        # 1. Ask Gemini for the code with streaming and thinking
+        raw_content, code = await self._stream_code(prompt, emit_thoughts=emit_thoughts)
+
+        if not raw_content:
+            print("[CadAgent DEBUG] [ERR] Empty response from model.")
+            return code, None, "The model returned an empty response."
+
+        # 2. Extract Code Block
+        if code is None:
+            # Fallback: assume entire text is code if no blocks, or fail
+            print("[CadAgent DEBUG] [WARN] No ```python block found. Trying heuristic...")
+            if "import build123d" in raw_content:
+                code = raw_content
+            else:
+                print("[CadAgent DEBUG] [ERR] Could not extract python code.")
+                return code, None, "No ```python code block was found in the response."
+
+        # Reject obviously broken scripts before paying for an execution
+        problems = _preflight(code)
+        if problems:
+            print(f"[CadAgent DEBUG] [ERR] Preflight failed: {problems}")
+            return code, None, "Preflight check failed: " + "; ".join(problems)
+
+        # 3. Execute in its own temp directory
+        attempt_dir, error = await self._execute(code)
+        return code, attempt_dir, error
+
+    async def _race_attempts(self, prompt: str, n: int):
+        """
+        Runs `n` attempts concurrently and returns the first that succeeds.
+        The remaining attempts are cancelled. Returns (code, attempt_dir, error).
+        An exception from the Gemini call itself (quota, auth, network) is not a script failure and
+        never ends up in retry feedback: it is re-raised only if every attempt raised, otherwise the
+        script failure of another attempt is returned so the retry loop carries on.
+        """
+        tasks = [
+            asyncio.create_task(self._one_attempt(prompt, emit_thoughts=(i == 0)))
+            for i in range(n)
+        ]
+        last_error = None
+        api_error = None
+        winner = None
+        try:
+            for fut in asyncio.as_completed(tasks):
+                try:
+                    code, attempt_dir, error = await fut
+                except Exception as e:
+                    print(f"[CadAgent DEBUG] [ERR] Attempt raised: {e}")
+                    api_error = api_error or e
+                    continue
+                if error is None:
+                    winner = (code, attempt_dir, None)
+                    break
+                last_error = error
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Let cancelled attempts clean up their temp dirs; a second success that
+            # finished at the same time is discarded here too
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, tuple) and result[1] and (winner is None or result[1] != winner[1]):
+                    shutil.rmtree(result[1], ignore_errors=True)
+        if winner is None and last_error is None and api_error is not None:
+            raise api_error
+        return winner or (None, None, last_error or "Unknown error")
+
+    async def _run(self, initial_prompt: str, build_feedback, script_path: str, label: str, speculative: bool = False):
+        """
+        Shared retry loop for generation and iteration. Each round streams, checks and executes a
+        script; on failure the classified error is turned into the next prompt by `build_feedback`.
+        Args:
+            initial_prompt: Prompt for the first round.
+            build_feedback: Callable (category, summary) -> prompt for the next round.
+            script_path: Where the successful script is saved; its STL goes next to it.
+            label: "generation" or "iteration", used in logs and the failure status.
+            speculative: Sample `speculative_attempts` scripts concurrently on the first round.
+        Returns (result, code), or (None, None) if every attempt failed. Errors from the Gemini
+        call itself propagate instead of being retried as script failures.
+        """
+        max_retries = 3
+        current_prompt = initial_prompt
+        
+        for attempt in range(max_retries):
+            print(f"[CadAgent DEBUG] {label.capitalize()} Attempt {attempt + 1}/{max_retries}")
+            
+            # Emit status update
+            if self.on_status:
+                status_info = {
+                    "status": "generating" if attempt == 0 else "retrying",
+                    "attempt": attempt + 1,
+                    "max_attempts": max_retries,
+                    "error": None
+                }
+                self.on_status(status_info)
+            
+            # Speculate on the first round only; retries carry error feedback and run one at a time
+            n = max(1, self.speculative_attempts) if speculative and attempt == 0 else 1
+            code, attempt_dir, error_msg = await self._race_attempts(current_prompt, n)
+            
+            if error_msg is not None:
+                # Extract a concise error message for display
+                error_lines = error_msg.strip().split('\n')
+                short_error = error_lines[-1][:100] if error_lines else "Unknown error"
+                
+                # Emit retry status with error
+                if self.on_status:
+                    self.on_status({
+                        "status": "retrying",
+                        "attempt": attempt + 1,
+                        "max_attempts": max_retries,
+                        "error": short_error
+                    })
+                
+                # Preparing feedback for next attempt
+                current_prompt = build_feedback(*_classify_error(error_msg))
+                continue # Retry loop
+            
+            # Keep the winning script and STL next to the previous design
+            result = await self._save_result(code, attempt_dir, os.path.dirname(script_path), script_path)
+            return result, code
+
+        # If loop finishes without success
+        print("[CadAgent DEBUG] [ERR] All attempts failed.")
+        if self.on_status:
+            self.on_status({
+                "status": "failed",
+                "attempt": max_retries,
+                "max_attempts": max_retries,
+                "error": f"All {label} attempts failed"
+            })
+        return None, None
 
     async def generate_prototype(self, prompt: str, output_dir: Optional[str] = None):
         """
         Generates 3D geometry by asking Gemini for a script, then running it LOCALLY.
+        The first round samples `speculative_attempts` scripts concurrently and keeps the first
+        that runs; later rounds retry serially with the error fed back to the model.
         Args:
             prompt: User's description of the model to generate.
             output_dir: Directory to save the script and STL. If None, uses temp dir.
@@ -75,162 +930,51 @@ export_stl(result_part, 'output.stl')
                 os.makedirs(output_dir, exist_ok=True)
                 work_dir = output_dir
             else:
-                import tempfile
                 work_dir = tempfile.gettempdir()
             
-            # Generate timestamped filename
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            output_stl = os.path.join(work_dir, f"output_{timestamp}.stl")
             script_path = os.path.join(work_dir, "current_design.py")
 
-            max_retries = 3
-            current_prompt = f"You are a build123d expert. Write a generic python script to create a 3D model of: {prompt}. Ensure you export to 'output.stl'. Unscaled."
-            
-            for attempt in range(max_retries):
-                print(f"[CadAgent DEBUG] Attempt {attempt + 1}/{max_retries}")
-                
-                # Emit status update
-                if self.on_status:
-                    status_info = {
-                        "status": "generating" if attempt == 0 else "retrying",
-                        "attempt": attempt + 1,
-                        "max_attempts": max_retries,
-                        "error": None
-                    }
-                    self.on_status(status_info)
-                
-                # 1. Ask Gemini for the code with streaming and thinking
-                raw_content = ""
-                stream = await self.client.aio.models.generate_content_stream(
-                    model=self.model,
-                    contents=current_prompt,
-                    config=types.GenerateContentConfig(
-                        system_instruction=self.system_instruction,
-                        temperature=1.0,
-                        thinking_config=types.ThinkingConfig(include_thoughts=True)
-                    )
-                )
-                async for chunk in stream:
-                    if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts:
-                        for part in chunk.candidates[0].content.parts:
-                            if not part.text:
-                                continue
-                            elif part.thought:
-                                # Stream thought to callback
-                                if self.on_thought:
-                                    self.on_thought(part.text)
-                            else:
-                                # Accumulate answer text
-                                raw_content += part.text
-                
-                if not raw_content:
-                    print("[CadAgent DEBUG] [ERR] Empty response from model.")
-                    return None
-
-                # 2. Extract Code Block
-                import re
-                code_match = re.search(r'```python(.*?)```', raw_content, re.DOTALL)
-                if code_match:
-                    code = code_match.group(1).strip()
-                else:
-                    # Fallback: assume entire text is code if no blocks, or fail
-                    print("[CadAgent DEBUG] [WARN] No ```python block found. Trying heuristic...")
-                    if "import build123d" in raw_content:
-                        code = raw_content
-                    else:
-                        print("[CadAgent DEBUG] [ERR] Could not extract python code.")
-                        return None
-                
-                # 3. Save to Local File in cad_outputs folder
-                # Fix for Windows paths in python strings: escape backslashes
-                safe_output_path = output_stl.replace("\\", "\\\\")
-                
-                with open(script_path, "w") as f:
-                    # Inject output path into the script
-                    code_with_path = code.replace("output.stl", safe_output_path)
-                    f.write(code_with_path)
-                    
-                print(f"[CadAgent DEBUG] [EXEC] Running local script: {script_path}")
-                
-                # 4. Execute Locally
-                import subprocess
-                import sys
-                
-                # Use the current Python interpreter (unified environment with build123d + mediapipe)
-                try:
-                    proc = await asyncio.to_thread(
-                        subprocess.run,
-                        [sys.executable, script_path],
-                        capture_output=True,
-                        text=True
-                    )
-                    stdout, stderr = proc.stdout, proc.stderr
-                except Exception as e:
-                     print(f"[CadAgent DEBUG] [ERR] Subprocess run failed: {e}")
-                     proc = type('obj', (object,), {'returncode': 1})
-                     stdout = ""
-                     stderr = str(e)
-                
-                if proc.returncode != 0:
-                    error_msg = stderr
-                    # Extract a concise error message for display
-                    error_lines = error_msg.strip().split('\n')
-                    short_error = error_lines[-1][:100] if error_lines else "Unknown error"
-                    print(f"[CadAgent DEBUG] [ERR] Script Execution Failed:\n{error_msg}")
-                    
-                    # Emit retry status with error
-                    if self.on_status:
-                        self.on_status({
-                            "status": "retrying",
-                            "attempt": attempt + 1,
-                            "max_attempts": max_retries,
-                            "error": short_error
-                        })
-                    
-                    # Preparing feedback for next attempt
-                    current_prompt = f"""
-The Python script you generated failed to execute with the following error:
-{error_msg}
+            # Identical prompts reuse the cached script and STL, skipping Gemini and execution
+            cache_key = self._cache_key(prompt)
+            cached = await asyncio.to_thread(self._cache_load, cache_key)
+            if cached:
+                code, stl_data = cached
+                output_stl = _unique_output_path(work_dir)
+                print(f"[CadAgent DEBUG] [CACHE] Hit for prompt, writing '{output_stl}'.")
+                async with aiofiles.open(script_path, "w") as f:
+                    await f.write(_inject_output_path(code, output_stl))
+                async with aiofiles.open(output_stl, "wb") as f:
+                    await f.write(stl_data)
+                self._last_script_path = script_path
+                self._last_code = code
+                return {
+                    "format": "stl",
+                    "data": stl_data,
+                    "file_path": output_stl
+                }
+
+            def build_feedback(category, summary):
+                return f"""
+Your previous attempt failed with the following error:
+Category: {category}
+Summary:
+{summary}
 
 Please fix the code to resolve this error. Return the full corrected script. 
-Ensure you still export to 'output.stl'.
+Ensure you still export with `export_stl(result_part, OUTPUT_STL)`.
 Original request: {prompt}
 """
-                    continue # Retry loop
-                
-                print(f"[CadAgent DEBUG] [OK] Script executed successfully.")
-                
-                # 5. Read Output
-                if os.path.exists(output_stl):
-                    print(f"[CadAgent DEBUG] [file] '{output_stl}' found.")
-                    with open(output_stl, "rb") as f:
-                        stl_data = f.read()
-                        
-                    import base64
-                    b64_stl = base64.b64encode(stl_data).decode('utf-8')
-                    
-                    return {
-                        "format": "stl",
-                        "data": b64_stl,
-                        "file_path": output_stl
-                    }
-                else:
-                     print(f"[CadAgent DEBUG] [ERR] '{output_stl}' was not generated.")
-                     # If script ran but no output, treat as failure and retry?
-                     # Ideally yes.
-                     current_prompt = f"The script executed successfully but 'output.stl' was not found. Ensure you call `export_stl(result_part, 'output.stl')` at the end."
-                     continue
-
-            # If loop finishes without success
-            print("[CadAgent DEBUG] [ERR] All attempts failed.")
-            if self.on_status:
-                self.on_status({
-                    "status": "failed",
-                    "attempt": max_retries,
-                    "max_attempts": max_retries,
-                    "error": "All generation attempts failed"
-                })
-            return None
+
+            result, code = await self._run(
+                initial_prompt=f"You are a build123d expert. Write a generic python script to create a 3D model of: {prompt}. Ensure you export with `export_stl(result_part, OUTPUT_STL)`. Unscaled.",
+                build_feedback=build_feedback,
+                script_path=script_path,
+                label="generation",
+                speculative=True
+            )
+            if result:
+                await asyncio.to_thread(self._cache_store, cache_key, code, result["data"])
+            return result
 
         except Exception as e:
             print(f"CadAgent Error: {e}")
@@ -252,43 +996,58 @@ Original request: {prompt}
             os.makedirs(output_dir, exist_ok=True)
             work_dir = output_dir
         else:
-            import tempfile
             work_dir = tempfile.gettempdir()
         
-        # Generate timestamped filename for the output
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Without a project folder, follow the script of the last successful run
         script_path = os.path.join(work_dir, "current_design.py")
-        output_stl = os.path.join(work_dir, f"output_{timestamp}.stl")
+        if not output_dir and self._last_script_path:
+            script_path = self._last_script_path
         
         existing_code = ""
         
-        if os.path.exists(script_path):
-            with open(script_path, "r") as f:
-                existing_code = f.read()
+        if self._last_code and script_path == self._last_script_path:
+            # Chained iteration on the design we just produced
+            existing_code = self._last_code
+        elif os.path.exists(script_path):
+            async with aiofiles.open(script_path, "r") as f:
+                existing_code = await f.read()
+            
+            # The model only ever sees the OUTPUT_STL name, never the injected absolute path
+            existing_code = _strip_output_path(existing_code)
             
-            # Sanitize existing code: replace any absolute paths with 'output.stl'
+            # Sanitize scripts saved before OUTPUT_STL existed: replace absolute paths with OUTPUT_STL
             # This prevents the LLM from seeing/reproducing Windows paths that cause Unicode escape errors
-            import re
             # Match both escaped (\\) and unescaped (\) Windows paths to output.stl
             existing_code = re.sub(
                 r"['\"]C:\\\\?Users\\\\?[^'\"]+\\\\?output[^'\"]*\.stl['\"]",
-                "'output.stl'",
+                "OUTPUT_STL",
                 existing_code
             )
             # Also handle forward-slash variants
             existing_code = re.sub(
                 r"['\"]C:/Users/[^'\"]+/output[^'\"]*\.stl['\"]",
-                "'output.stl'",
+                "OUTPUT_STL",
                 existing_code
             )
         else:
              print("[CadAgent DEBUG] [WARN] No existing script found. Falling back to fresh generation.")
-             return await self.generate_prototype(prompt)
+             return await self.generate_prototype(prompt, output_dir=output_dir)
 
         try:
+            def build_feedback(category, summary):
+                return f"""
+Your previous attempt at the updated script failed with the following error:
+Category: {category}
+Summary:
+{summary}
 
-            max_retries = 3
-            current_prompt = f"""
+Please fix the code to resolve this error. Return the full corrected script. 
+Ensure you still export with `export_stl(result_part, OUTPUT_STL)`.
+User Request: {prompt}
+"""
+
+            result, _ = await self._run(
+                initial_prompt=f"""
 You are iterating on an existing 3D model script.
 
 Current Python Code:
@@ -299,146 +1058,16 @@ Current Python Code:
 User Request: {prompt}
 
 Task: Rewrite the code to satisfy the user's request while maintaining the rest of the model structure.
-Ensure you still export to 'output.stl'.
-"""
-            
-            for attempt in range(max_retries):
-                print(f"[CadAgent DEBUG] Iteration Attempt {attempt + 1}/{max_retries}")
-                
-                # Emit status update
-                if self.on_status:
-                    status_info = {
-                        "status": "generating" if attempt == 0 else "retrying",
-                        "attempt": attempt + 1,
-                        "max_attempts": max_retries,
-                        "error": None
-                    }
-                    self.on_status(status_info)
-                
-                # 1. Ask Gemini for the code with streaming and thinking
-                raw_content = ""
-                stream = await self.client.aio.models.generate_content_stream(
-                    model=self.model,
-                    contents=current_prompt,
-                    config=types.GenerateContentConfig(
-                        system_instruction=self.system_instruction,
-                        temperature=1.0,
-                        thinking_config=types.ThinkingConfig(include_thoughts=True)
-                    )
-                )
-                async for chunk in stream:
-                    if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts:
-                        for part in chunk.candidates[0].content.parts:
-                            if not part.text:
-                                continue
-                            elif part.thought:
-                                # Stream thought to callback
-                                if self.on_thought:
-                                    self.on_thought(part.text)
-                            else:
-                                # Accumulate answer text
-                                raw_content += part.text
-                
-                if not raw_content:
-                    print("[CadAgent DEBUG] [ERR] Empty response from model.")
-                    return None
-
-                # 2. Extract Code Block
-                import re
-                code_match = re.search(r'```python(.*?)```', raw_content, re.DOTALL)
-                if code_match:
-                    code = code_match.group(1).strip()
-                else:
-                    # Fallback: assume entire text is code if no blocks, or fail
-                    print("[CadAgent DEBUG] [WARN] No ```python block found. Trying heuristic...")
-                    if "import build123d" in raw_content:
-                        code = raw_content
-                    else:
-                        print("[CadAgent DEBUG] [ERR] Could not extract python code.")
-                        return None
-                
-                # 3. Save to Local File in cad_outputs folder
-                # Overwrite the script so the next iteration builds on this one
-                
-                # Fix for Windows paths in python strings: escape backslashes
-                safe_output_path = output_stl.replace("\\", "\\\\")
-                
-                with open(script_path, "w") as f:
-                    # Inject output path into the script
-                    code_with_path = code.replace("output.stl", safe_output_path)
-                    f.write(code_with_path)
-                    
-                print(f"[CadAgent DEBUG] [EXEC] Running local script: {script_path}")
-                
-                # 4. Execute Locally
-                import subprocess
-                import sys
-                
-                # Use asyncio.to_thread for Windows compatibility (asyncio.create_subprocess_exec
-                # throws NotImplementedError on Windows with certain event loop policies)
-                try:
-                    proc = await asyncio.to_thread(
-                        subprocess.run,
-                        [sys.executable, script_path],
-                        capture_output=True,
-                        text=True
-                    )
-                    stdout, stderr = proc.stdout, proc.stderr
-                except Exception as e:
-                    print(f"[CadAgent DEBUG] [ERR] Subprocess run failed: {e}")
-                    proc = type('obj', (object,), {'returncode': 1})()
-                    stdout = ""
-                    stderr = str(e)
-                
-                if proc.returncode != 0:
-                    error_msg = stderr
-                    print(f"[CadAgent DEBUG] [ERR] Script Execution Failed:\n{error_msg}")
-                    
-                    # Preparing feedback for next attempt
-                    current_prompt = f"""
-The updated Python script you generated failed to execute with the following error:
-{error_msg}
-
-Please fix the code to resolve this error. Return the full corrected script. 
-Ensure you still export to 'output.stl'.
-"""
-                    continue # Retry loop
-                
-                print(f"[CadAgent DEBUG] [OK] Script executed successfully.")
-                
-                # 5. Read Output
-                if os.path.exists(output_stl):
-                    print(f"[CadAgent DEBUG] [file] '{output_stl}' found.")
-                    with open(output_stl, "rb") as f:
-                        stl_data = f.read()
-                        
-                    import base64
-                    b64_stl = base64.b64encode(stl_data).decode('utf-8')
-                    
-                    return {
-                        "format": "stl",
-                        "data": b64_stl,
-                        "file_path": output_stl
-                    }
-                else:
-                     print(f"[CadAgent DEBUG] [ERR] '{output_stl}' was not generated.")
-                     current_prompt = f"The script executed successfully but '{output_stl}' was not found. Ensure you call `export_stl(result_part, 'output.stl')` at the end."
-                     continue
-
-            # If loop finishes without success
-            print("[CadAgent DEBUG] [ERR] All attempts failed.")
-            if self.on_status:
-                self.on_status({
-                    "status": "failed",
-                    "attempt": max_retries,
-                    "max_attempts": max_retries,
-                    "error": "All iteration attempts failed"
-                })
-            return None
+Ensure you still export with `export_stl(result_part, OUTPUT_STL)`.
+""",
+                build_feedback=build_feedback,
+                script_path=script_path,
+                label="iteration"
+            )
+            return result
 
         except Exception as e:
             print(f"CadAgent Error: {e}")
             import traceback
             traceback.print_exc()
             return None
-
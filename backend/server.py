@@ -204,6 +204,7 @@ async def start_audio(sid, data=None):
     if audio_loop:
         if loop_task and (loop_task.done() or loop_task.cancelled()):
              print("Audio loop task appeared finished/cancelled. Clearing and restarting...")
+             audio_loop.stop()  # Releases its CAD workers
              audio_loop = None
              loop_task = None
         else:
@@ -843,16 +844,15 @@ async def print_stl(sid, data):
         if resolved_stl and os.path.exists(resolved_stl):
             # Open the STL in the CAD module for preview
             try:
-                import base64
                 with open(resolved_stl, 'rb') as f:
                     stl_data = f.read()
-                stl_b64 = base64.b64encode(stl_data).decode('utf-8')
                 stl_filename = os.path.basename(resolved_stl)
                 
                 print(f"[SERVER] Opening STL in CAD module: {stl_filename}")
+                # Raw bytes are sent as a binary attachment
                 await sio.emit('cad_data', {
                     'format': 'stl',
-                    'data': stl_b64,
+                    'data': stl_data,
                     'filename': stl_filename
                 })
             except Exception as e:
@@ -28,7 +28,7 @@ const LoadingCube = () => {
 };
 
 const CadWindow = ({ data, thoughts, retryInfo = {}, onClose, socket }) => {
-    // data format: { format: "stl", data: "base64..." }
+    // data format: { format: "stl", data: ArrayBuffer | "base64..." }
     const [isIterating, setIsIterating] = useState(false);
     const [prompt, setPrompt] = useState("");
     const [isSending, setIsSending] = useState(false);
@@ -50,17 +50,26 @@ const CadWindow = ({ data, thoughts, retryInfo = {}, onClose, socket }) => {
         if (!data || data.format !== 'stl' || !data.data) return null;
 
         try {
-            // Convert Base64 to ArrayBuffer
-            const byteCharacters = atob(data.data);
-            const byteNumbers = new Array(byteCharacters.length);
-            for (let i = 0; i < byteCharacters.length; i++) {
-                byteNumbers[i] = byteCharacters.charCodeAt(i);
+            let buffer;
+            if (typeof data.data === 'string') {
+                // Legacy: convert Base64 to ArrayBuffer
+                const byteCharacters = atob(data.data);
+                const byteNumbers = new Array(byteCharacters.length);
+                for (let i = 0; i < byteCharacters.length; i++) {
+                    byteNumbers[i] = byteCharacters.charCodeAt(i);
+                }
+                buffer = new Uint8Array(byteNumbers).buffer;
+            } else if (data.data instanceof ArrayBuffer) {
+                // Binary Socket.IO attachment
+                buffer = data.data;
+            } else {
+                // Typed array / Buffer view: copy out just its bytes
+                buffer = data.data.buffer.slice(data.data.byteOffset, data.data.byteOffset + data.data.byteLength);
             }
-            const byteArray = new Uint8Array(byteNumbers);
 
             // Parse directly using THREE.STLLoader
             const loader = new STLLoader();
-            const geom = loader.parse(byteArray.buffer);
+            const geom = loader.parse(buffer);
             geom.center(); // Optional: Center the geometry
             return geom;
         } catch (e) {
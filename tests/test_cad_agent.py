@@ -4,10 +4,126 @@ Tests for CAD Generation Agent.
 import pytest
 import asyncio
 import os
+import tempfile
+from types import SimpleNamespace
 
 from cad_agent import CadAgent
 
 
+# A script that "exports" without needing build123d
+GOOD_SCRIPT = (
+    "result_part = 1\n"
+    "export_stl = lambda part, path: open(path, 'w').write('solid')\n"
+    "export_stl(result_part, OUTPUT_STL)"
+)
+
+
+def _chunk(text, thought=False):
+    """Builds a streamed response chunk holding one part."""
+    part = SimpleNamespace(text=text, thought=thought)
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+class FakeStream:
+    """Async stream of chunks; a number in `items` sleeps for that many seconds."""
+    
+    def __init__(self, items):
+        self.items = items
+        self.sent = 0
+        self.closed = False
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self):
+        while self.sent < len(self.items):
+            item = self.items[self.sent]
+            self.sent += 1
+            if isinstance(item, (int, float)):
+                await asyncio.sleep(item)
+                continue
+            return _chunk(*item) if isinstance(item, tuple) else _chunk(item)
+        raise StopAsyncIteration
+    
+    async def aclose(self):
+        self.closed = True
+
+
+class FakeModels:
+    """Stands in for `client.aio.models`; the Nth call gets responses[N] (or the last one)."""
+    
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+        self.streams = []
+        self.instruction_tokens = 200
+        self.token_counts = 0
+    
+    async def count_tokens(self, model, contents):
+        self.token_counts += 1
+        return SimpleNamespace(total_tokens=self.instruction_tokens)
+    
+    async def generate_content_stream(self, model, contents, config):
+        self.calls.append(contents)
+        response = self.responses[min(len(self.calls), len(self.responses)) - 1]
+        if isinstance(response, Exception):
+            raise response
+        stream = FakeStream(response)
+        self.streams.append(stream)
+        return stream
+
+
+class FakeCaches:
+    """Stands in for `client.aio.caches`; `create` raises the queued errors first."""
+    
+    def __init__(self):
+        self.errors = []
+        self.created = []
+        self.updated = []
+        self.deleted = []
+    
+    async def create(self, model, config):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.created.append(config)
+        return SimpleNamespace(name=f"cachedContents/{len(self.created)}")
+    
+    async def update(self, name, config):
+        self.updated.append(name)
+    
+    async def delete(self, name):
+        self.deleted.append(name)
+
+
+def _answer(code):
+    """Splits a model answer wrapping `code` into a thought and small text chunks."""
+    text = f"Here you go:\n```python\n{code}\n```\nThis script builds the part."
+    return [("thinking...", True)] + [text[i:i + 7] for i in range(0, len(text), 7)]
+
+
+@pytest.fixture
+def fake_agent(monkeypatch, tmp_path):
+    """Returns a factory for CadAgents talking to a FakeModels client, with temp files under tmp_path."""
+    agents = []
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(scratch))
+    
+    def make(responses):
+        models = FakeModels(responses)
+        models.caches = FakeCaches()
+        client = SimpleNamespace(aio=SimpleNamespace(models=models, caches=models.caches))
+        monkeypatch.setattr(CadAgent, "_client", client)
+        agent = CadAgent()
+        agent.cache_dir = str(tmp_path / "cache")
+        agents.append(agent)
+        return agent, models
+    
+    yield make
+    for agent in agents:
+        agent.close()
+
+
 class TestCadAgentInit:
     """Test CadAgent initialization."""
     
@@ -130,3 +246,425 @@ class TestBuild123dImport:
             print(f"build123d version: {build123d.__version__}")
         except ImportError:
             pytest.skip("build123d not installed")
+
+
+class TestCodeExtraction:
+    """Test fenced code block extraction from model output."""
+    
+    def test_python_block(self):
+        """Test a standard ```python block."""
+        from cad_agent import _extract_code
+        raw = "Here you go:\n```python\nfrom build123d import *\nresult_part = Box(1, 1, 1)\n```\nDone."
+        assert _extract_code(raw) == "from build123d import *\nresult_part = Box(1, 1, 1)"
+    
+    def test_long_and_tilde_fences(self):
+        """Test 4-backtick and ~~~ fences with nested shorter fences inside."""
+        from cad_agent import _extract_code
+        raw = "````py\ndef f():\n    '''\n    ```\n    '''\n````"
+        assert _extract_code(raw) == "def f():\n    '''\n    ```\n    '''"
+        assert _extract_code("~~~\nx = 1\n~~~") == "x = 1"
+    
+    def test_skips_non_python_block(self):
+        """Test that non-python blocks are skipped and incomplete blocks rejected."""
+        from cad_agent import _extract_code
+        raw = "```text\nnotes\n```\n```python-3\nx = 1\n```"
+        assert _extract_code(raw) == "x = 1"
+        assert _extract_code("```python\nx = 1\n") is None
+
+    def test_python_block_beats_earlier_unlabeled(self):
+        """Test that an unlabeled plan block is only a fallback for a python block."""
+        from cad_agent import _extract_code
+        raw = "Plan:\n```\nstep 1\n```\n```python\nx = 1\n```"
+        assert _extract_code(raw) == "x = 1"
+        assert _extract_code("Plan:\n```\nstep 1\n```\n") == "step 1"
+        assert _extract_code("Plan:\n```\nstep 1\n```\n", allow_unlabeled=False) is None
+    
+    def test_opener_after_prose(self):
+        """Test a fence opened at the end of a line of prose."""
+        from cad_agent import _extract_code
+        assert _extract_code("Here you go: ```python\nx = 1\n```") == "x = 1"
+        # Without a language tag a trailing ``` is prose, not an opener
+        assert _extract_code("Done ```\nx = 1\n```") is None
+        # Inline code mid-sentence doesn't open a block tagged with the next word
+        assert _extract_code("Inline ```python x``` here\n```python\nx = 6\n```") == "x = 6"
+
+
+class TestCadCache:
+    """Test the prompt-keyed generation cache."""
+    
+    def test_cache_roundtrip(self, temp_dir, sample_stl_content):
+        """Test that a stored generation is returned for the same prompt only."""
+        agent = CadAgent()
+        agent.cache_dir = str(temp_dir)
+        key = agent._cache_key("A simple 10mm cube")
+        
+        assert agent._cache_load(key) is None
+        agent._cache_store(key, "result_part = Box(10, 10, 10)", sample_stl_content.encode())
+        
+        code, stl_data = agent._cache_load(key)
+        assert code == "result_part = Box(10, 10, 10)"
+        assert stl_data == sample_stl_content.encode()
+        assert agent._cache_load(agent._cache_key("A sphere")) is None
+
+
+class TestErrorClassification:
+    """Test stderr classification used for retry feedback."""
+    
+    def test_pascalcase_name_error(self):
+        """Test that old PascalCase API names are tagged and summarized."""
+        from cad_agent import _classify_error
+        stderr = (
+            "Traceback (most recent call last):\n"
+            "  File \"gen.py\", line 5, in <module>\n"
+            "    Fillet(p.edges(), radius=1)\n"
+            "NameError: name 'Fillet' is not defined\n"
+        )
+        category, summary = _classify_error(stderr)
+        assert category == "OLD_PASCALCASE_API"
+        assert summary == "    Fillet(p.edges(), radius=1)\nNameError: name 'Fillet' is not defined"
+    
+    def test_fillet_failure(self):
+        """Test that OpenCascade failures inside fillet calls are tagged."""
+        from cad_agent import _classify_error
+        stderr = "    fillet(p.edges(), radius=20)\nStdFail_NotDone: BRep_API: command not done"
+        assert _classify_error(stderr)[0] == "FILLET_RADIUS_TOO_LARGE"
+        assert _classify_error("") == ("RUNTIME_ERROR", "Unknown error")
+    
+    def test_long_stderr_is_classified_quickly(self):
+        """Test that 16 KB of fillet warnings without a failure marker doesn't backtrack."""
+        import time
+        from cad_agent import _classify_error
+        stderr = "Warning: fillet adjusted\n" * 700 + "ValueError: bad size"
+        start = time.perf_counter()
+        assert _classify_error(stderr)[0] == "VALUE_ERROR"
+        assert time.perf_counter() - start < 0.1
+    
+    def test_responses_without_a_script(self):
+        """Test that missing code is not reported as a runtime error."""
+        from cad_agent import _classify_error
+        assert _classify_error("The model returned an empty response.")[0] == "EMPTY_RESPONSE"
+        assert _classify_error("No ```python code block was found in the response.")[0] == "NO_CODE_BLOCK"
+
+
+class TestPreflight:
+    """Test static checks run before executing generated scripts."""
+    
+    def test_valid_script(self):
+        """Test that a well-formed script passes."""
+        from cad_agent import _preflight
+        code = "from build123d import *\nresult_part = Box(1, 1, 1)\nexport_stl(result_part, OUTPUT_STL)"
+        assert _preflight(code) == []
+        # A hardcoded file name would bypass the injected output path
+        assert len(_preflight(code.replace("OUTPUT_STL", "'output.stl'"))) == 1
+        # Keyword form of the export
+        assert _preflight(code.replace("OUTPUT_STL)", "file_path=OUTPUT_STL)")) == []
+    
+    def test_broken_scripts(self):
+        """Test that PascalCase calls, missing result/export and syntax errors are reported."""
+        from cad_agent import _preflight
+        problems = _preflight("with BuildPart() as p:\n    Fillet(p.edges(), radius=1)")
+        assert len(problems) == 3
+        assert "Fillet()" in problems[0]
+        assert _preflight("x = (")[0].startswith("SyntaxError")
+
+
+class TestOutputPathInjection:
+    """Test the OUTPUT_STL header added to generated scripts."""
+    
+    def test_inject_and_strip(self):
+        """Test that Windows paths survive injection and the header strips cleanly."""
+        from cad_agent import _inject_output_path, _strip_output_path
+        code = "result_part = Box(1, 1, 1)\nexport_stl(result_part, OUTPUT_STL)"
+        injected = _inject_output_path(code, "C:\\Users\\me\\output.stl")
+        namespace = {}
+        exec(injected.split("\n")[0], namespace)
+        assert namespace["OUTPUT_STL"] == "C:\\Users\\me\\output.stl"
+        assert _strip_output_path(injected) == code
+        assert _strip_output_path(code) == code
+    
+    def test_inject_after_future_imports(self):
+        """Test that the header goes after the docstring and __future__ imports."""
+        from cad_agent import _inject_output_path, _strip_output_path
+        code = '"""Bracket."""\nfrom __future__ import annotations\nresult_part = 1'
+        injected = _inject_output_path(code, "/tmp/output.stl")
+        assert injected.split("\n")[2] == "OUTPUT_STL = '/tmp/output.stl'"
+        compile(injected, "gen.py", "exec")
+        assert _strip_output_path(injected) == code
+
+
+class TestOutputPaths:
+    """Test that concurrent generations get distinct output files."""
+    
+    def test_unique_output_path(self, temp_dir):
+        """Test that each call claims a new STL path in the same directory."""
+        from cad_agent import _unique_output_path
+        paths = {_unique_output_path(str(temp_dir)) for _ in range(3)}
+        assert len(paths) == 3
+        assert all(os.path.exists(p) and p.endswith(".stl") for p in paths)
+
+
+class TestSharedClient:
+    """Test that agents share one Gemini client."""
+    
+    def test_client_is_shared(self):
+        """Test that two agents reuse the same client instance."""
+        assert CadAgent().client is CadAgent().client
+
+
+class TestSpeculativeAttempts:
+    """Test the concurrent first round, early stream stop and API error handling."""
+    
+    async def test_first_success_wins(self, fake_agent, tmp_path):
+        """Test that the fast attempt wins and the slow one is cancelled without leftovers."""
+        agent, models = fake_agent([_answer(GOOD_SCRIPT), [("thinking...", True), 30] + _answer(GOOD_SCRIPT)])
+        result = await agent.generate_prototype("A cube", output_dir=str(tmp_path / "out"))
+        
+        assert result["format"] == "stl" and result["data"] == b"solid"
+        assert len(models.calls) == 2
+        # The loser was cancelled while waiting on its stream
+        assert models.streams[1].sent == 2
+        assert sorted(os.listdir(tmp_path / "out")) == ["current_design.py", os.path.basename(result["file_path"])]
+        assert not [name for name in os.listdir(tmp_path / "scratch") if name.startswith("ada_cad_")]
+    
+    async def test_stream_stops_after_code_block(self, fake_agent):
+        """Test that reading stops once the code block closes."""
+        agent, models = fake_agent([_answer(GOOD_SCRIPT) + ["more text"] * 50])
+        raw_content, code = await agent._stream_code("A cube")
+        
+        assert code == GOOD_SCRIPT
+        assert models.streams[0].closed
+        assert models.streams[0].sent < len(models.streams[0].items)
+    
+    async def test_unlabeled_block_does_not_stop_stream(self, fake_agent):
+        """Test that a plan in an unlabeled block doesn't end the read before the script."""
+        agent, models = fake_agent([["Plan:\n```\nstep 1\n```\n", 0, "```python\n" + GOOD_SCRIPT + "\n```\n"]])
+        raw_content, code = await agent._stream_code("A cube")
+        assert code == GOOD_SCRIPT
+    
+    async def test_split_nested_fence_does_not_close_block(self, fake_agent):
+        """Test that a docstring "```python" split after its backticks doesn't end the block."""
+        code = "def f():\n    '''\n    ```python\n    '''\n" + GOOD_SCRIPT
+        agent, models = fake_agent([[
+            "```python\ndef f():\n    '''\n    ```",
+            "python\n    '''\n" + GOOD_SCRIPT + "\n``",
+            "`"
+        ]])
+        raw_content, extracted = await agent._stream_code("A cube")
+        
+        # The closing fence had no newline yet, so it was only accepted once the stream ended
+        assert extracted == code
+        assert models.streams[0].sent == 3
+    
+    async def test_mixed_api_error_and_script_failure_retries(self, fake_agent, tmp_path):
+        """Test that a script failure next to a raised attempt still drives the serial retries."""
+        statuses = []
+        broken = GOOD_SCRIPT.replace("result_part = 1", "result_part = 1 / 0")
+        agent, models = fake_agent([
+            RuntimeError("429 RESOURCE_EXHAUSTED"),
+            _answer(broken),
+            _answer(GOOD_SCRIPT)
+        ])
+        agent.on_status = statuses.append
+        
+        result = await agent.generate_prototype("A cube", output_dir=str(tmp_path / "out"))
+        assert result["data"] == b"solid"
+        assert len(models.calls) == 3
+        assert "ZeroDivisionError" in models.calls[2]
+        assert "429" not in models.calls[2]
+        assert "retrying" in [s["status"] for s in statuses]
+    
+    async def test_api_error_is_not_retried_as_script_failure(self, fake_agent, tmp_path):
+        """Test that a quota error ends the generation instead of being fed back to the model."""
+        statuses = []
+        agent, models = fake_agent([RuntimeError("429 RESOURCE_EXHAUSTED")])
+        agent.on_status = statuses.append
+        
+        assert await agent.generate_prototype("A cube", output_dir=str(tmp_path / "out")) is None
+        # One speculative round, no retries
+        assert len(models.calls) == agent.speculative_attempts
+        assert [s["status"] for s in statuses] == ["generating"]
+
+
+class TestCadWorker:
+    """Test the persistent script worker (runs offline on sys.executable)."""
+    
+    @pytest.fixture
+    def worker(self):
+        """Start a worker and kill it afterwards."""
+        from cad_agent import _CadWorker
+        worker = _CadWorker()
+        yield worker
+        worker.close()
+    
+    def test_runs_scripts_and_reports_errors(self, worker, tmp_path):
+        """Test that output is discarded and a failing script returns its traceback."""
+        ok_script = tmp_path / "ok.py"
+        ok_script.write_text("print('noise')")
+        bad_script = tmp_path / "bad.py"
+        bad_script.write_text("raise ValueError('boom')")
+        
+        assert worker.run(str(ok_script)) == (0, "")
+        returncode, stderr = worker.run(str(bad_script))
+        assert returncode == 1
+        assert "ValueError: boom" in stderr
+    
+    def test_nonzero_exit_reports_code(self, worker, tmp_path):
+        """Test that sys.exit(n) without a traceback still explains the failure."""
+        script = tmp_path / "exit.py"
+        script.write_text("import sys\nsys.exit(3)")
+        assert worker.run(str(script)) == (1, "SystemExit: the script exited with code 3\n")
+    
+    def test_output_path_is_predefined(self, worker, tmp_path):
+        """Test that OUTPUT_STL is defined without shifting traceback line numbers."""
+        script = tmp_path / "gen.py"
+        script.write_text("open(OUTPUT_STL, 'w').write('solid')\nraise ValueError('line 2')")
+        returncode, stderr = worker.run(str(script), str(tmp_path / "output.stl"))
+        assert returncode == 1
+        assert "line 2, in <module>" in stderr
+        assert (tmp_path / "output.stl").read_text() == "solid"
+    
+    def test_scripts_are_isolated(self, worker, tmp_path):
+        """Test that stdin, cwd and planted modules don't leak between scripts."""
+        first = tmp_path / "first.py"
+        first.write_text(
+            "import os, sys, types\n"
+            "assert sys.stdin.read() == ''\n"
+            "sys.modules['leak'] = types.ModuleType('leak')\n"
+            f"os.chdir({str(tmp_path)!r})\n"
+        )
+        second = tmp_path / "second.py"
+        second.write_text(
+            "import os, sys\n"
+            "assert 'leak' not in sys.modules\n"
+            f"assert os.getcwd() == {os.getcwd()!r}\n"
+        )
+        assert worker.run(str(first)) == (0, "")
+        assert worker.run(str(second)) == (0, "")
+    
+    def test_timeout_kills_worker(self, worker, tmp_path):
+        """Test that a script running past its timeout is stopped with its worker."""
+        script = tmp_path / "slow.py"
+        script.write_text("import time\ntime.sleep(30)")
+        
+        with pytest.raises(TimeoutError):
+            worker.run(str(script), timeout=1)
+        worker.proc.wait(timeout=5)
+        assert not worker.alive()
+
+
+class TestWorkerPool:
+    """Test CadAgent's pool of persistent workers."""
+    
+    def test_concurrent_runs_and_close(self, fake_agent, tmp_path):
+        """Test that threads share the pool safely, it stays bounded and close() empties it."""
+        from concurrent.futures import ThreadPoolExecutor
+        from cad_agent import _MAX_IDLE_WORKERS
+        agent, _ = fake_agent([])
+        script = tmp_path / "ok.py"
+        script.write_text("x = 1")
+        
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            results = list(pool.map(lambda _: agent._run_script(str(script)), range(12)))
+        assert results == [(0, "")] * 12
+        assert 1 <= len(agent._idle_workers) <= _MAX_IDLE_WORKERS
+        assert not agent._busy_workers
+        
+        workers = list(agent._idle_workers)
+        agent.close()
+        assert not agent._idle_workers
+        assert all(not worker.alive() for worker in workers)
+        # A run after close() doesn't return its worker to the pool
+        assert agent._run_script(str(script)) == (0, "")
+        assert not agent._idle_workers
+
+
+class TestContextCache:
+    """Test the background Gemini context cache for the system instruction."""
+    
+    async def test_small_instruction_is_not_cached(self, fake_agent):
+        """Test that an instruction below the minimum is sent inline without a create call."""
+        agent, models = fake_agent([])
+        assert agent._get_gen_config() is agent._gen_config
+        await agent._context_cache_task
+        assert agent._get_gen_config() is agent._gen_config
+        assert agent._context_cache_task.done()
+        assert models.token_counts == 1
+        assert models.caches.created == []
+    
+    async def test_create_renew_and_delete(self, fake_agent):
+        """Test that the cache is built off the request path, extended in place and deleted on close."""
+        import time
+        agent, models = fake_agent([])
+        models.instruction_tokens = 10000
+        models.caches.errors.append(RuntimeError("503 UNAVAILABLE"))
+        
+        # A transient failure backs off instead of disabling the cache
+        assert agent._get_gen_config() is agent._gen_config
+        await agent._context_cache_task
+        assert not agent._context_cache_unavailable
+        agent._context_cache_retry_at = 0.0
+        
+        # The first request doesn't wait for the cache
+        assert agent._get_gen_config() is agent._gen_config
+        await agent._context_cache_task
+        assert agent._get_gen_config().cached_content == "cachedContents/1"
+        
+        # Close to expiry the TTL is extended rather than a new cache created
+        agent._context_cache_expires = time.monotonic() + 120
+        assert agent._get_gen_config().cached_content == "cachedContents/1"
+        await agent._context_cache_task
+        assert models.caches.updated == ["cachedContents/1"]
+        assert len(models.caches.created) == 1
+        
+        agent.close()
+        await agent._context_cache_task
+        assert models.caches.deleted == ["cachedContents/1"]
+
+
+class TestThoughts:
+    """Test thought delivery to on_thought and thoughts() consumers."""
+    
+    async def test_every_consumer_gets_every_thought(self, fake_agent):
+        """Test that on_thought and a thoughts() iterator both receive each thought."""
+        received = []
+        iterated = []
+        agent, _ = fake_agent([_answer(GOOD_SCRIPT)])
+        agent.on_thought = received.append
+        
+        async def consume():
+            async for text in agent.thoughts():
+                iterated.append(text)
+        consumer = asyncio.create_task(consume())
+        await asyncio.sleep(0)
+        
+        await agent._stream_code("A cube")
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert received == ["thinking..."]
+        assert iterated == ["thinking..."]
+        
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+        agent.close()
+        assert agent._thought_pump is None
+        assert agent._thought_queues == []
+    
+    async def test_no_backlog_without_consumers(self, fake_agent):
+        """Test that thoughts aren't queued with no consumer, so a later one sees only new ones."""
+        iterated = []
+        agent, _ = fake_agent([_answer(GOOD_SCRIPT), [("second", True)] + _answer(GOOD_SCRIPT)[1:]])
+        await agent._stream_code("A cube")
+        assert agent._thought_queues == []
+        
+        async def consume():
+            async for text in agent.thoughts():
+                iterated.append(text)
+        consumer = asyncio.create_task(consume())
+        await asyncio.sleep(0)
+        await agent._stream_code("A cube")
+        await asyncio.sleep(0)
+        assert iterated == ["second"]
+        
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+        assert agent._thought_queues == []